@@ -1,8 +1,28 @@
 #!/usr/bin/env python3
 import serial
+import array
+import fcntl
+import http.client
+import os
+import select
+import socket
+import termios
 import time
 import sys
 import json
+import logging
+import queue
+import re
+import threading
+
+try:
+    import orjson
+    json_dumps = orjson.dumps
+except ImportError:  # stdlib fallback, same compact bytes output
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+log = logging.getLogger("telemetry")
 
 # === CONFIGURATION ===
 MODEM_PORT = '/dev/serial0'         # UART to SIM7600 (GPIO pins)
@@ -13,184 +33,545 @@ APN       = 'internet.orange.co.bw' # Your carrier's APN
 HOST      = 'merlet.alwaysdata.net'
 ENDPOINT  = '/api/data'             # Updated: The endpoint for our Node.js server
 SOCKET_ID = 0
+STATE_FILE = '/run/telemetry_modem.state' # APN/IP of the last good init; gone after reboot
+PERIOD    = 1.0                     # Max seconds between batch flush checks
+QUEUE_MAX = 100                     # Parsed samples buffered between reader and sender
+ERR_LOG_EVERY = 100                 # Log the first bad sensor line, then every Nth
+LINE_MAX = 4096                     # Longer sensor lines are dropped as garbage
+
+# 'at' sends through AT+CIPSEND on MODEM_PORT. 'socket' uses a plain kernel TCP
+# connection over the modem's wwan0 interface, which must already be up, e.g.
+#   qmicli -d /dev/cdc-wdm0 --wds-start-network="apn='internet.orange.co.bw'"
+TRANSPORT = os.environ.get('TRANSPORT', 'at')
+# Socket transport tuning: busy-poll the receive queue for this many µs before
+# sleeping (off by default, try 50 when the process is pinned to a core), and
+# never let the send buffer drop below one full batch so a POST is written in one go
+BUSY_POLL_US = int(os.environ.get('BUSY_POLL_US', '0'))
+SNDBUF_MIN   = 4096
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)  # Python < 3.12 lacks the constant
+
+# Batching: the first BATCH_AFTER samples go out one by one, after that up to
+# BATCH_MAX samples share one POST, flushed at least every BATCH_MS
+BATCH_AFTER = 1
+BATCH_MAX   = 5                     # keeps one CIPSEND under the SIM7600's 1500-byte limit
+BATCH_MS    = 5000
+
+# Final result codes that end a plain AT command reply
+AT_DONE = (b"\r\nOK\r\n", b"\r\nERROR\r\n")
+CIPOPEN_RE = re.compile(rb"\+CIPOPEN: (\d+),(\d+)")
+# URC replies that follow "OK"; matched as whole lines so the status code is
+# always in the response. A non-zero close code is followed by ERROR, so only
+# code 0 may end a close early -- otherwise that ERROR would be left behind
+# for the next command to read.
+NETOPEN_DONE  = (re.compile(rb"\+NETOPEN: \d+\r\n"), b"\r\nERROR\r\n")
+NETCLOSE_DONE = (re.compile(rb"\+NETCLOSE: 0\r\n"), b"\r\nERROR\r\n")
+CIPOPEN_DONE  = (re.compile(rb"\+CIPOPEN: \d+,\d+\r\n"), b"\r\nERROR\r\n")
+CIPCLOSE_DONE = (re.compile(rb"\+CIPCLOSE: \d+,0\r\n"), b"\r\nERROR\r\n")
+IPADDR_RE  = re.compile(rb"\+IPADDR: ([0-9.]+)")
+IPD_RE     = re.compile(rb"\+IPD(\d+)\r\n")  # header of data received on the socket
+
+# One "key=value" pair of a sensor line such as b"speed=50,temp=36.2,gear=3"
+KV_RE = re.compile(rb"\s*([A-Za-z_][A-Za-z0-9_]*)\s*=\s*([^,\s]+)")
+# Keys the STM32 emits -> sensor_type sent to the server; other keys are dropped
+SENSOR_NAMES = {
+    b"speed": "speed",
+    b"temp":  "temperature",
+    b"gear":  "gear",
+    b"fuel":  "fuel",
+    b"rpm":   "rpm",
+}
+NUMBER_START = b"-.0123456789"  # first byte of anything float() can take here
+# The STM32's usual frame, all SENSOR_NAMES keys in order, matched in one go;
+# anything else falls back to KV_RE pair by pair
+FRAME_KEYS = tuple(SENSOR_NAMES)
+FRAME_NAMES = tuple(SENSOR_NAMES.values())
+FRAME_RE = re.compile(b",".join(re.escape(k) + rb"=(-?\d+(?:\.\d+)?)" for k in FRAME_KEYS))
+
+# Constant parts of the HTTP request; only Content-Length changes per send
+HTTP_HEAD = (
+    f"POST {ENDPOINT} HTTP/1.1\r\n"
+    f"Host: {HOST}\r\n"
+    "Connection: keep-alive\r\n"
+    "Content-Type: application/json\r\n"
+    "Content-Length: "
+).encode('ascii')
+HTTP_TAIL = b"\r\n\r\n"
+CIPSEND_FMT = b"AT+CIPSEND=%d,%d\r\n"
 
 # === AT-COMMAND HELPERS ===
-def send_at(ser, cmd, wait=1):
-    """Sends an AT command and returns the response."""
-    print(f"📡 Sending AT: {cmd}")
+_pollers = {}  # fd -> select.poll() watching it for input
+
+def _poller(ser):
+    fd = ser.fileno()
+    poller = _pollers.get(fd)
+    if poller is None:
+        poller = _pollers[fd] = select.poll()
+        poller.register(fd, select.POLLIN)
+    return poller
+
+def read_until(ser, terminators=AT_DONE, timeout=1):
+    """Reads until any terminator (bytes or compiled regex) shows up or the timeout ends."""
+    fd = ser.fileno()
+    poller = _poller(ser)
+    deadline = time.time() + timeout
+    buf = bytearray()
+    while True:
+        remaining_ms = int((deadline - time.time()) * 1000)
+        if remaining_ms <= 0 or not poller.poll(remaining_ms):
+            break
+        chunk = os.read(fd, 4096)
+        if not chunk:  # port went away
+            break
+        buf += chunk
+        if any(t.search(buf) if isinstance(t, re.Pattern) else t in buf
+               for t in terminators):
+            break
+    return bytes(buf)
+
+def send_at(ser, cmd, timeout=1, terminators=AT_DONE):
+    """Sends an AT command and returns the response as soon as the modem has answered."""
+    log.debug("📡 Sending AT: %s", cmd)
     ser.write((cmd + '\r\n').encode())
-    time.sleep(wait)
-    response = ser.read_all().decode(errors='ignore')
-    print(f"📩 Response: {response}")
+    response = read_until(ser, terminators, timeout)
+    log.debug("📩 Response: %r", response)
     return response
 
-def wait_for(ser, keyword, timeout=5):
-    """Waits for a specific keyword in the serial buffer."""
+def strip_ipd(buf):
+    """Returns buf without "+IPD<len>" payloads, and how many payload bytes are to come."""
+    # +IPD blocks carry the server's reply, whose HTML may contain a '>'
+    out = bytearray()
+    pos = 0
+    while True:
+        m = IPD_RE.search(buf, pos)
+        if not m:
+            out += buf[pos:]
+            return out, 0
+        out += buf[pos:m.start()]
+        pos = m.end() + int(m.group(1))
+        if pos >= len(buf):
+            return out, pos - len(buf)
+
+def wait_for(ser, keyword, timeout=5, _buf=bytearray()):
+    """Waits for a specific bytes keyword in the serial buffer."""
+    fd = ser.fileno()
+    poller = _poller(ser)
     deadline = time.time() + timeout
-    buf = ''
-    while time.time() < deadline:
-        buf += ser.read(ser.in_waiting or 1).decode(errors='ignore')
-        if keyword in buf:
+    _buf.clear()  # shared across calls; only the modem thread waits
+    while True:
+        remaining_ms = int((deadline - time.time()) * 1000)
+        if remaining_ms <= 0 or not poller.poll(remaining_ms):
+            break
+        chunk = os.read(fd, 4096)
+        if not chunk:  # port went away
+            break
+        _buf.extend(chunk)
+        if strip_ipd(_buf)[0].find(keyword) != -1:
             return True
-    print(f"⏰ Timed out waiting for '{keyword}'")
+    log.warning("⏰ Timed out waiting for %r", keyword)
     return False
 
+def writev_all(ser, chunks):
+    """Writes all chunks with one writev() syscall."""
+    # a short write is finished with ser.write()
+    try:
+        n = os.writev(ser.fileno(), chunks)
+    except BlockingIOError:  # pyserial opens the port non-blocking
+        n = 0
+    for chunk in chunks:
+        if n >= len(chunk):
+            n -= len(chunk)
+            continue
+        ser.write(memoryview(chunk)[n:])
+        n = 0
+
+def check_last_send(ser):
+    """Drains what the modem reported since the last send and logs any failure."""
+    resp = ser.read(ser.in_waiting)
+    if not resp:
+        return
+    resp, missing = strip_ipd(resp)
+    if missing:  # the server's reply is still arriving; read and drop the rest
+        ser.read(missing)
+    log.debug("🛬 Modem response since last send: %r", resp)
+    if any(t in resp for t in (b"\r\nERROR\r\n", b"+CIPERROR:", b"+IPCLOSE:")):
+        log.warning("⚠️ Previous send failed or socket closed: %r", resp)
+
+# === SENSOR PORT TUNING ===
+ASYNC_LOW_LATENCY = 1 << 13  # from linux/serial.h
+
+def enable_low_latency(ser):
+    """Makes the USB serial driver deliver bytes immediately instead of every 16 ms."""
+    try:
+        try:
+            ser.set_low_latency_mode(True)
+        except AttributeError:  # pyserial < 3.5
+            buf = array.array('i', [0] * 32)
+            fcntl.ioctl(ser.fileno(), termios.TIOCGSERIAL, buf)
+            buf[4] |= ASYNC_LOW_LATENCY  # serial_struct.flags
+            fcntl.ioctl(ser.fileno(), termios.TIOCSSERIAL, buf)
+    except (OSError, ValueError) as e:
+        log.warning("⚠️ Could not set low-latency mode on %s: %s", ser.port, e)
+
+    # FTDI-style adapters also buffer for latency_timer ms (default 16)
+    tty = os.path.basename(os.path.realpath(ser.port))
+    try:
+        with open(f"/sys/bus/usb-serial/devices/{tty}/latency_timer", "w") as f:
+            f.write("1")
+    except OSError:
+        pass  # not a usb-serial device, or not running as root
+
+def sensor_lines(ser, stop, timeout=1):
+    """Yields complete lines from the sensor port until stop is set."""
+    # one os.read() per chunk that arrives, instead of readline()'s read per byte
+    fd = ser.fileno()
+    poller = _poller(ser)
+    buf = bytearray()
+    scanned = 0       # bytes of buf already known to hold no newline
+    skipping = False  # dropping the rest of a line that went over LINE_MAX
+    while not stop.is_set():
+        if not poller.poll(timeout * 1000):
+            continue
+        chunk = os.read(fd, 4096)
+        if not chunk:  # readable but empty: the adapter was unplugged
+            raise serial.SerialException(f"{ser.port} returned no data")
+        buf += chunk
+        start = 0
+        end = buf.find(b"\n", scanned)  # earlier bytes were already searched
+        while end >= 0:
+            if skipping:  # tail of an overlong line
+                skipping = False
+            else:
+                yield bytes(buf[start:end + 1])
+            start = end + 1
+            end = buf.find(b"\n", start)
+        del buf[:start]
+        if len(buf) > LINE_MAX:
+            if not skipping:
+                yield bytes(buf)  # the reader rejects it as too long
+            skipping = True
+            buf.clear()
+        scanned = len(buf)
+
+# === MODEM STATE ACROSS RESTARTS ===
+def load_modem_state():
+    """Returns the {'apn': ..., 'ip': ...} saved by the last successful init, or None."""
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_modem_state(ipaddr_response):
+    """Records the APN and the IP from an AT+IPADDR reply for the next start."""
+    m = IPADDR_RE.search(ipaddr_response)
+    if not m:
+        return
+    try:
+        with open(STATE_FILE, 'w') as f:
+            json.dump({'apn': APN, 'ip': m.group(1).decode()}, f)
+    except OSError as e:
+        log.debug("Could not write %s: %s", STATE_FILE, e)
+
+def modem_is_warm(ser):
+    """Returns the saved state if the bearer is still open with our APN, else None."""
+    state = load_modem_state()
+    if not state or state.get('apn') != APN:
+        return None
+    if b"+NETOPEN: 1" not in send_at(ser, "AT+NETOPEN?"):
+        return None
+    return state
+
 # === MODEM INIT & TCP SOCKET OPEN ===
-def init_modem(ser):
-    """Initializes the modem by checking each step and opens a TCP socket."""
-    print("--- Modem Initialization ---")
-    
-    # Check basic communication and SIM status
-    send_at(ser, "ATE0") # Echo off
-        
+def open_bearer(ser):
+    """Checks SIM and network attachment, sets the APN and opens the network bearer."""
+    # Check SIM status
     response = send_at(ser, "AT+CPIN?")
-    if "+CPIN: READY" not in response:
-        print("🚨 SIM card not ready. Check SIM card.")
-        print(f"Response was: {response}")
+    if b"+CPIN: READY" not in response:
+        log.error("🚨 SIM card not ready. Check SIM card.")
+        log.error("Response was: %r", response)
         sys.exit(1)
-    print("✅ SIM Ready.")
+    log.info("✅ SIM Ready.")
 
     # Check GPRS/LTE network attachment
     # It might take a few tries to attach
     for i in range(3):
         response = send_at(ser, "AT+CGATT?")
-        if "+CGATT: 1" in response:
-            print("✅ Attached to GPRS/LTE network.")
+        if b"+CGATT: 1" in response:
+            log.info("✅ Attached to GPRS/LTE network.")
             break
-        print(f"⏳ Not attached to network yet (attempt {i+1}/3), waiting...")
+        log.info("⏳ Not attached to network yet (attempt %d/3), waiting...", i + 1)
         time.sleep(3)
     else: # This else belongs to the for loop, runs if loop finishes without break
-        print("🚨 Failed to attach to GPRS/LTE network.")
+        log.error("🚨 Failed to attach to GPRS/LTE network.")
         sys.exit(1)
 
     # Configure APN and open network bearer
     send_at(ser, f'AT+CGDCONT=1,"IP","{APN}"')
     
     # Close network bearer just in case it was open before
-    send_at(ser, "AT+NETCLOSE", wait=1)
+    send_at(ser, "AT+NETCLOSE", terminators=NETCLOSE_DONE)
 
-    response = send_at(ser, "AT+NETOPEN", wait=5) # This can take a while
-    if "+NETOPEN: 0" not in response:
-        print("🚨 Failed to open network bearer. Check APN and signal strength.")
+    # Report CIPSEND as soon as data leaves the modem, not after the peer's TCP ACK
+    send_at(ser, "AT+CIPSENDMODE=0")
+
+    # "OK" comes first, the "+NETOPEN: <err>" URC later; this can take a while
+    response = send_at(ser, "AT+NETOPEN", timeout=10, terminators=NETOPEN_DONE)
+    if b"+NETOPEN: 0" not in response:
+        log.error("🚨 Failed to open network bearer. Check APN and signal strength.")
         sys.exit(1)
-    print("✅ Network bearer open.")
+    log.info("✅ Network bearer open.")
+
+    save_modem_state(send_at(ser, "AT+IPADDR"))
+
+def init_modem(ser):
+    """Initializes the modem and opens a TCP socket."""
+    # the bearer setup is skipped on a warm restart
+    log.info("--- Modem Initialization ---")
+    
+    # Check basic communication
+    send_at(ser, "ATE0") # Echo off
 
-    send_at(ser, "AT+IPADDR") # Just to see our IP
+    state = modem_is_warm(ser)
+    if state:
+        log.info("♻️ Network bearer still open (IP %s); skipping SIM/attach/APN setup.",
+                 state.get('ip'))
+        # Drop a socket a crashed run may have left open
+        send_at(ser, f'AT+CIPCLOSE={SOCKET_ID}', 2, terminators=CIPCLOSE_DONE)
+    else:
+        open_bearer(ser)
 
     # Finally, open the TCP socket
-    print("--- Opening TCP Socket ---")
+    log.info("--- Opening TCP Socket ---")
     oc = f'AT+CIPOPEN={SOCKET_ID},"TCP","{HOST}",80'
-    response = send_at(ser, oc, wait=8) # This can also take a while
-    
-    if f"+CIPOPEN: {SOCKET_ID},0" in response:
-        print("✅ TCP socket open successfully.")
+    # This can also take a while
+    response = send_at(ser, oc, timeout=10, terminators=CIPOPEN_DONE)
+
+    m = CIPOPEN_RE.search(response)
+    if m and int(m.group(1)) == SOCKET_ID and m.group(2) == b"0":
+        log.info("✅ TCP socket open successfully.")
     else:
-        print(f"🚨 Socket open failed. Final attempt failed. Response:\n{response}")
+        log.error("🚨 Socket open failed. Final attempt failed. Response: %r", response)
         sys.exit(1)
 
+# === KERNEL SOCKET TRANSPORT ===
+class KeepAliveHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection that tunes every socket it (re)opens for small, frequent POSTs."""
+
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) < SNDBUF_MIN:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SNDBUF_MIN)
+        if BUSY_POLL_US:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, BUSY_POLL_US)
+            except OSError:
+                pass  # raising it above net.core.busy_read needs CAP_NET_ADMIN
+
+def http_post(conn, body):
+    """POSTs a JSON body on the persistent connection."""
+    # on failure the connection is closed so the next request reconnects
+    try:
+        conn.request("POST", ENDPOINT, body, {"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        resp.read()
+        log.debug("🛬 Server response: %s %s", resp.status, resp.reason)
+    except (OSError, http.client.HTTPException) as e:
+        log.warning("⚠️ HTTP POST failed: %s", e)
+        conn.close()
+
 # === SEND SENSOR DATA AS JSON ===
-def send_json_data(ser, params: dict):
-    """Transforms sensor data to JSON and sends it via HTTP POST."""
-    
-    # 1. Transform the flat dictionary into a list of objects
-    json_payload_list = []
-    for key, value in params.items():
+def parse_number(v):
+    """Returns a sensor value as an int when it has no decimal point, else as a float."""
+    if b"." in v or len(v) > 18:  # longer digit runs may not fit orjson's 64-bit ints
+        return float(v)
+    try:
+        return int(v)
+    except ValueError:
+        return float(v)  # e.g. b"1e3"
+
+def parse_sample(line):
+    """Returns {sensor_type: number} for the known, numeric pairs of a sensor line."""
+    m = FRAME_RE.fullmatch(line)
+    if m:  # fast path: the full frame in the usual order, all numbers
+        return {name: parse_number(v) for name, v in zip(FRAME_NAMES, m.groups())}
+    sample = {}
+    for m in KV_RE.finditer(line):
+        name = SENSOR_NAMES.get(m.group(1).lower())  # also standardizes temp -> temperature
+        value = m.group(2)
+        if name is None or value[:1] not in NUMBER_START:
+            continue
         try:
-            sensor_type = key.strip().lower()
-            # Standardize sensor names if necessary (e.g., temp -> temperature)
-            if sensor_type == "temp":
-                sensor_type = "temperature"
-            
-            json_payload_list.append({
-                "sensor_type": sensor_type,
-                "value": float(value)  # Convert value to a number
-            })
-        except (ValueError, TypeError):
-            print(f"⚠️ Could not process key-value pair: {key}={value}. Skipping.")
+            sample[name] = parse_number(value)
+        except ValueError:
             continue
+    return sample
+
+def send_json_batch(link, samples: list):
+    """Sends samples from parse_sample() as one JSON array."""
+    # link is the modem port or, with TRANSPORT=socket, a KeepAliveHTTPConnection
+
+    # 1. Flatten every sample's dictionary into one list of objects
+    json_payload_list = [{"sensor_type": sensor_type, "value": number}
+                         for params in samples for sensor_type, number in params.items()]
     
     if not json_payload_list:
-        print("🤷 No valid data to send.")
+        log.info("🤷 No valid data to send.")
+        return
+
+    # 2. Create the JSON body (already bytes)
+    json_bytes = json_dumps(json_payload_list)
+    if TRANSPORT == 'socket':  # http.client adds the headers itself
+        http_post(link, json_bytes)
         return
 
-    # 2. Create the JSON string
-    json_string = json.dumps(json_payload_list)
-    
     # 3. Construct the full HTTP POST request
-    http_payload = (
-        f"POST {ENDPOINT} HTTP/1.1\r\n"
-        f"Host: {HOST}\r\n"
-        f"Connection: keep-alive\r\n"
-        f"Content-Type: application/json\r\n"
-        f"Content-Length: {len(json_string)}\r\n"
-        f"\r\n"
-        f"{json_string}"
-    )
-
-    print(f"🌐 Full HTTP payload:\n{http_payload}")
-    payload_length = len(http_payload.encode('utf-8'))
+    http_header = HTTP_HEAD + b"%d" % len(json_bytes) + HTTP_TAIL
+
+    log.debug("🌐 Full HTTP payload: %r %r", http_header, json_bytes)
+    payload_length = len(http_header) + len(json_bytes)
 
     # 4. Send the data using AT commands
-    ser.reset_input_buffer()
-    cmd = f'AT+CIPSEND={SOCKET_ID},{payload_length}'
-    ser.write((cmd + '\r\n').encode())
+    check_last_send(link)
+    link.write(CIPSEND_FMT % (SOCKET_ID, payload_length))
 
-    if not wait_for(ser, '>'):
-        print("⚠️ No '>' prompt from modem; skipping send.")
+    if not wait_for(link, b'>'):
+        log.warning("⚠️ No '>' prompt from modem; skipping send.")
         return
 
-    ser.write(http_payload.encode('utf-8'))
-    print(f"📤 Sent JSON: {json_string}")
-    
-    # Wait for and print the server's response
-    time.sleep(3) # Increased wait for server response
-    response = ser.read_all().decode(errors='ignore')
-    print(f"🛬 Modem response after send:\n{response}")
+    writev_all(link, [http_header, json_bytes])
+    log.debug("📤 Sent JSON: %r", json_bytes)
+    # the "+CIPSEND:" ack is picked up by check_last_send() on the next send
+
+class BatchingManager:
+    """Sends samples as one POST once BATCH_MAX are queued or BATCH_MS have passed."""
+
+    def __init__(self, link):
+        self.link = link
+        self.buf = []
+        self.last_flush = time.time()
+        self.sent = 0
+
+    def add(self, sample: dict):
+        self.buf.append(sample)
+        self.poll()
+
+    def poll(self):
+        """Flushes the buffer if it is full or old enough; cheap to call every loop."""
+        if not self.buf:
+            return
+        if (self.sent < BATCH_AFTER
+                or len(self.buf) >= BATCH_MAX
+                or time.time() - self.last_flush > BATCH_MS / 1000):
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            try:
+                send_json_batch(self.link, self.buf)
+                self.sent += len(self.buf)
+            finally:
+                self.buf.clear()  # never resend a batch that just failed
+        self.last_flush = time.time()
+
+# === SENSOR READER ===
+def sensor_reader(sensor, samples, stop, failed):
+    """Reads and parses STM32 lines in a background thread."""
+    # lines keep flowing while the modem is busy
+    err_count = 0
+    try:
+        for line in sensor_lines(sensor, stop):
+            line = line.strip()
+            if not line:
+                log.debug("...No complete line received. Waiting...")
+                continue
+
+            log.debug("📨 Received from STM32: %r", line)
+            try:
+                if len(line) > LINE_MAX:
+                    raise ValueError("line over LINE_MAX bytes")
+                # Example line: b"speed=50,temp=36.2,gear=3,fuel=80,rpm=3200"
+                data_dict = parse_sample(line)  # unknown keys and bad values are dropped
+                if not data_dict:
+                    raise ValueError("no valid key=value pairs")
+                samples.put_nowait(data_dict)
+            except queue.Full:
+                log.warning("⚠️ Sample queue full, dropping: %r", line)
+            except Exception as e:
+                # a garbled stream must not turn into one log line per sample
+                err_count += 1
+                if err_count == 1 or err_count % ERR_LOG_EVERY == 0:
+                    log.warning("⚠️ Parse errors: %d, last: %s on line: %r",
+                                err_count, e, line[:64])
+    except (serial.SerialException, OSError) as e:
+        log.error("❌ Sensor port error: %s", e)
+        failed.set()
+    finally:
+        stop.set()
 
 # === MAIN LOOP ===
 def main():
     """Main function to initialize devices and start the data loop."""
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO").upper(),
+                        format="%(message)s")
+    if TRANSPORT not in ('at', 'socket'):
+        log.error("❌ Unknown TRANSPORT %r (expected 'at' or 'socket')", TRANSPORT)
+        sys.exit(1)
     try:
-        modem = serial.Serial(MODEM_PORT, BAUD_MODEM, timeout=1)
+        modem = None
+        if TRANSPORT == 'at':
+            modem = serial.Serial(MODEM_PORT, BAUD_MODEM, timeout=1)
         sensor = serial.Serial(DATA_PORT, BAUD_DATA, timeout=1)
     except Exception as e:
-        print(f"❌ Serial port open error: {e}")
+        log.error("❌ Serial port open error: %s", e)
         sys.exit(1)
 
-    init_modem(modem)
-    print("\n▶️ Reading sensor data from STM32 and sending to server...")
+    enable_low_latency(sensor)
+    if modem:
+        init_modem(modem)
+        link = modem
+    else:
+        # Connects lazily on the first POST and reconnects after failures
+        link = KeepAliveHTTPConnection(HOST, 80, timeout=10)
+    log.info("▶️ Reading sensor data from STM32 and sending to server...")
+    batcher = BatchingManager(link)
 
-    try:
-        while True:
-            print("...Checking for data from STM32...")
-            line = sensor.readline().decode(errors='ignore').strip()
-            if not line:
-                print("...No complete line received. Waiting...")
-                time.sleep(1) # Wait before trying again
-                continue
+    # The reader thread owns the sensor port, this thread owns the uplink
+    samples = queue.Queue(maxsize=QUEUE_MAX)
+    stop = threading.Event()
+    failed = threading.Event()  # set by the reader when the sensor port dies
+    reader = threading.Thread(target=sensor_reader, args=(sensor, samples, stop, failed),
+                              daemon=True)
+    reader.start()
 
-            print(f"\n📨 Received from STM32: {line}")
+    try:
+        while not stop.is_set():
             try:
-                # Example line: "speed=50,temp=36.2,gear=3,fuel=80,rpm=3200"
-                entries = [x.split('=') for x in line.split(',')]
-                data_dict = {k.strip(): v.strip() for k, v in entries if len(k.strip()) > 0}
-                if data_dict:
-                    send_json_data(modem, data_dict)
-                else:
-                    print("⚠️ Received empty or malformed data.")
-            except Exception as e:
-                print(f"⚠️ Data processing error: {e} on line: '{line}'")
-            
-            time.sleep(2) # Delay between sends
+                batcher.add(samples.get(timeout=PERIOD))
+            except queue.Empty:
+                batcher.poll()
 
     except KeyboardInterrupt:
-        print("\n✋ Ctrl+C detected, closing connection...")
+        log.info("✋ Ctrl+C detected, closing connection...")
     finally:
-        send_at(modem, f'AT+CIPCLOSE={SOCKET_ID}', 2)
-        send_at(modem, 'AT+NETCLOSE', 1)
-        modem.close()
+        stop.set()
+        reader.join(timeout=2)
+        while not samples.empty():
+            batcher.add(samples.get_nowait())  # add() keeps each send within BATCH_MAX
+        batcher.flush()
+        if modem:
+            # The bearer stays open so the next start can skip its setup
+            send_at(modem, f'AT+CIPCLOSE={SOCKET_ID}', 2, terminators=CIPCLOSE_DONE)
+            modem.close()
+        else:
+            link.close()
         sensor.close()
-        print("✅ Cleanly shut down.")
+
+    if failed.is_set():
+        # non-zero so a supervisor (e.g. systemd Restart=on-failure) restarts us
+        sys.exit(1)
+    log.info("✅ Cleanly shut down.")
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
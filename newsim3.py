@@ -1,9 +1,28 @@
 #!/usr/bin/env python3
 import serial
+import array
+import fcntl
+import http.client
+import os
+import select
+import socket
+import termios
 import time
 import sys
 import json
-import traceback
+import logging
+import queue
+import re
+import threading
+
+try:
+    import orjson
+    json_dumps = orjson.dumps
+except ImportError:  # stdlib fallback, same compact bytes output
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+log = logging.getLogger("telemetry")
 
 # === CONFIGURATION ===
 MODEM_PORT = '/dev/serial0'         # UART to SIM7600 (GPIO pins)
@@ -14,151 +33,498 @@ APN        = 'internet.orange.co.bw'
 HOST       = 'merlet.alwaysdata.net'
 ENDPOINT   = '/api/data'
 SOCKET_ID  = 0
+STATE_FILE = '/run/telemetry_modem.state'  # APN/IP of the last good init; cleared on reboot
+PERIOD     = 1.0                    # max seconds between batch flush checks
+QUEUE_MAX  = 100                    # parsed samples buffered between reader and sender
+ERR_LOG_EVERY = 100                 # log the first bad sensor line, then every Nth
+LINE_MAX   = 4096                   # longer sensor lines are dropped as garbage
+
+# 'at': AT+CIPSEND over MODEM_PORT; 'socket': kernel TCP over wwan0, brought up first with
+#   qmicli -d /dev/cdc-wdm0 --wds-start-network="apn='internet.orange.co.bw'"
+TRANSPORT  = os.environ.get('TRANSPORT', 'at')
+# Socket transport: busy-poll for this many µs before sleeping (off by default,
+# try 50 once the process is pinned), and a send buffer of at least one full batch
+BUSY_POLL_US = int(os.environ.get('BUSY_POLL_US', '0'))
+SNDBUF_MIN   = 4096
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)  # missing before Python 3.12
+
+# Batching: the first BATCH_AFTER samples go out one by one, after that up to
+# BATCH_MAX samples share one POST, flushed at least every BATCH_MS
+BATCH_AFTER = 1
+BATCH_MAX   = 5             # keeps one CIPSEND under the SIM7600's 1500-byte limit
+BATCH_MS    = 5000
+
+# Final result codes that end a plain AT command reply
+AT_DONE = (b"\r\nOK\r\n", b"\r\nERROR\r\n")
+CIPOPEN_RE = re.compile(rb"\+CIPOPEN: (\d+),(\d+)")
+# URC replies that follow "OK"; matched as whole lines so the status code is
+# always in the response. A non-zero close code is followed by ERROR, so only
+# code 0 may end a close early -- otherwise that ERROR would be left behind
+# for the next command to read.
+NETOPEN_DONE  = (re.compile(rb"\+NETOPEN: \d+\r\n"), b"\r\nERROR\r\n")
+NETCLOSE_DONE = (re.compile(rb"\+NETCLOSE: 0\r\n"), b"\r\nERROR\r\n")
+CIPOPEN_DONE  = (re.compile(rb"\+CIPOPEN: \d+,\d+\r\n"), b"\r\nERROR\r\n")
+CIPCLOSE_DONE = (re.compile(rb"\+CIPCLOSE: \d+,0\r\n"), b"\r\nERROR\r\n")
+IPADDR_RE  = re.compile(rb"\+IPADDR: ([0-9.]+)")
+IPD_RE     = re.compile(rb"\+IPD(\d+)\r\n")  # header of data received on the socket
+
+# One "key=value" pair of a sensor line such as b"speed=50,temp=36.2,gear=3"
+KV_RE = re.compile(rb"\s*([A-Za-z_][A-Za-z0-9_]*)\s*=\s*([^,\s]+)")
+# Keys the STM32 emits -> sensor_type sent to the server; other keys are dropped
+SENSOR_NAMES = {
+    b"speed": "speed",
+    b"temp":  "temperature",
+    b"gear":  "gear",
+    b"fuel":  "fuel",
+    b"rpm":   "rpm",
+}
+NUMBER_START = b"-.0123456789"  # first byte of anything float() can take here
+# The STM32's usual frame, all SENSOR_NAMES keys in order, matched in one go;
+# anything else falls back to KV_RE pair by pair
+FRAME_KEYS = tuple(SENSOR_NAMES)
+FRAME_NAMES = tuple(SENSOR_NAMES.values())
+FRAME_RE = re.compile(b",".join(re.escape(k) + rb"=(-?\d+(?:\.\d+)?)" for k in FRAME_KEYS))
+
+# Constant parts of the HTTP request; only Content-Length changes per send
+HTTP_HEAD = (
+    f"POST {ENDPOINT} HTTP/1.1\r\n"
+    f"Host: {HOST}\r\n"
+    "Connection: keep-alive\r\n"
+    "Content-Type: application/json\r\n"
+    "Content-Length: "
+).encode('ascii')
+HTTP_TAIL = b"\r\n\r\n"
+CIPSEND_FMT = b"AT+CIPSEND=%d,%d\r\n"
 
 # === AT-COMMAND HELPERS ===
-def send_at(ser, cmd, wait=1):
-    print(f"📡 Sending AT: {cmd}")
+_pollers = {}  # fd -> select.poll() watching it for input
+
+def _poller(ser):
+    fd = ser.fileno()
+    poller = _pollers.get(fd)
+    if poller is None:
+        poller = _pollers[fd] = select.poll()
+        poller.register(fd, select.POLLIN)
+    return poller
+
+def read_until(ser, terminators=AT_DONE, timeout=1):
+    fd = ser.fileno()
+    poller = _poller(ser)
+    deadline = time.time() + timeout
+    buf = bytearray()
+    while True:
+        remaining_ms = int((deadline - time.time()) * 1000)
+        if remaining_ms <= 0 or not poller.poll(remaining_ms):
+            break
+        chunk = os.read(fd, 4096)
+        if not chunk:  # port went away
+            break
+        buf += chunk
+        # terminators are plain bytes or compiled patterns
+        if any(t.search(buf) if isinstance(t, re.Pattern) else t in buf
+               for t in terminators):
+            break
+    return bytes(buf)
+
+def send_at(ser, cmd, timeout=1, terminators=AT_DONE):
+    log.debug("📡 Sending AT: %s", cmd)
     ser.write((cmd + '\r\n').encode())
-    time.sleep(wait)
-    resp = ser.read_all().decode(errors='ignore')
-    print(f"📩 Response: {resp.strip()}")
+    resp = read_until(ser, terminators, timeout)
+    log.debug("📩 Response: %r", resp)
     return resp
 
-def wait_for(ser, keyword, timeout=5):
-    print(f"⏳ Waiting for '{keyword}' (up to {timeout}s)…")
+def strip_ipd(buf):
+    # server data arrives as "+IPD<len>\r\n<payload>"; drop the payloads so a '>'
+    # in e.g. HTML is never taken for the CIPSEND prompt. Also returns how many
+    # payload bytes are still to come.
+    out = bytearray()
+    pos = 0
+    while True:
+        m = IPD_RE.search(buf, pos)
+        if not m:
+            out += buf[pos:]
+            return out, 0
+        out += buf[pos:m.start()]
+        pos = m.end() + int(m.group(1))
+        if pos >= len(buf):
+            return out, pos - len(buf)
+
+def wait_for(ser, keyword, timeout=5, _buf=bytearray()):
+    log.debug("⏳ Waiting for %r (up to %ss)…", keyword, timeout)
+    fd = ser.fileno()
+    poller = _poller(ser)
     deadline = time.time() + timeout
-    buf = ''
-    while time.time() < deadline:
-        buf += ser.read(ser.in_waiting or 1).decode(errors='ignore')
-        if keyword in buf:
-            print(f"✅ Got '{keyword}'")
+    _buf.clear()  # shared across calls; only the modem thread waits
+    while True:
+        remaining_ms = int((deadline - time.time()) * 1000)
+        if remaining_ms <= 0 or not poller.poll(remaining_ms):
+            break
+        chunk = os.read(fd, 4096)
+        if not chunk:  # port went away
+            break
+        _buf.extend(chunk)
+        if strip_ipd(_buf)[0].find(keyword) != -1:
+            log.debug("✅ Got %r", keyword)
             return True
-    print(f"❌ Timeout waiting for '{keyword}'")
+    log.warning("❌ Timeout waiting for %r", keyword)
     return False
 
+def writev_all(ser, chunks):
+    try:
+        n = os.writev(ser.fileno(), chunks)
+    except BlockingIOError:  # pyserial opens the port non-blocking
+        n = 0
+    for chunk in chunks:
+        if n >= len(chunk):
+            n -= len(chunk)
+            continue
+        ser.write(memoryview(chunk)[n:])
+        n = 0
+
+def check_last_send(ser):
+    # Collects the previous send's "+CIPSEND: <id>,<req>,<cnf>" ack without waiting for it
+    resp = ser.read(ser.in_waiting)
+    if not resp:
+        return
+    resp, missing = strip_ipd(resp)
+    if missing:  # the server's reply is still arriving; read and drop the rest
+        ser.read(missing)
+    log.debug("🛬 Modem response since last send: %r", resp)
+    if any(t in resp for t in (b"\r\nERROR\r\n", b"+CIPERROR:", b"+IPCLOSE:")):
+        log.warning("⚠️ Previous send failed or socket closed: %r", resp)
+
+# === SENSOR PORT TUNING ===
+ASYNC_LOW_LATENCY = 1 << 13  # from linux/serial.h
+
+def enable_low_latency(ser):
+    try:
+        try:
+            ser.set_low_latency_mode(True)
+        except AttributeError:  # pyserial < 3.5
+            buf = array.array('i', [0] * 32)
+            fcntl.ioctl(ser.fileno(), termios.TIOCGSERIAL, buf)
+            buf[4] |= ASYNC_LOW_LATENCY  # serial_struct.flags
+            fcntl.ioctl(ser.fileno(), termios.TIOCSSERIAL, buf)
+    except (OSError, ValueError) as e:
+        log.warning("⚠️ Could not set low-latency mode on %s: %s", ser.port, e)
+
+    # FTDI-style adapters also buffer for latency_timer ms (default 16)
+    tty = os.path.basename(os.path.realpath(ser.port))
+    try:
+        with open(f"/sys/bus/usb-serial/devices/{tty}/latency_timer", "w") as f:
+            f.write("1")
+    except OSError:
+        pass  # not a usb-serial device, or not running as root
+
+def sensor_lines(ser, stop, timeout=1):
+    # one os.read() per chunk that arrives, instead of readline()'s read per byte
+    fd = ser.fileno()
+    poller = _poller(ser)
+    buf = bytearray()
+    scanned = 0       # bytes of buf already known to hold no newline
+    skipping = False  # dropping the rest of a line that went over LINE_MAX
+    while not stop.is_set():
+        if not poller.poll(timeout * 1000):
+            continue
+        chunk = os.read(fd, 4096)
+        if not chunk:  # readable but empty: the adapter was unplugged
+            raise serial.SerialException(f"{ser.port} returned no data")
+        buf += chunk
+        start = 0
+        end = buf.find(b"\n", scanned)  # earlier bytes were already searched
+        while end >= 0:
+            if skipping:  # tail of an overlong line
+                skipping = False
+            else:
+                yield bytes(buf[start:end + 1])
+            start = end + 1
+            end = buf.find(b"\n", start)
+        del buf[:start]
+        if len(buf) > LINE_MAX:
+            if not skipping:
+                yield bytes(buf)  # the reader rejects it as too long
+            skipping = True
+            buf.clear()
+        scanned = len(buf)
+
+# === MODEM STATE ACROSS RESTARTS ===
+def load_modem_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_modem_state(ipaddr_resp):
+    # only a bearer that actually got an IP is worth reusing
+    m = IPADDR_RE.search(ipaddr_resp)
+    if not m:
+        return
+    try:
+        with open(STATE_FILE, 'w') as f:
+            json.dump({'apn': APN, 'ip': m.group(1).decode()}, f)
+    except OSError as e:
+        log.debug("Could not write %s: %s", STATE_FILE, e)
+
+def modem_is_warm(ser):
+    # saved state for our APN *and* the modem says the bearer is still open
+    state = load_modem_state()
+    if not state or state.get('apn') != APN:
+        return None
+    if b"+NETOPEN: 1" not in send_at(ser, "AT+NETOPEN?"):
+        return None
+    return state
+
 # === MODEM INIT & SOCKET OPEN ===
 def init_modem(ser):
-    print("🔧 Initializing modem…")
+    log.info("🔧 Initializing modem…")
+    # (command, timeout, terminators) -- timeouts are upper bounds now
     steps = [
-        ('AT',       0.5),
-        ('ATE0',     0.5),
-        ('AT+CPIN?', 0.5),
-        ('AT+CGATT?',0.5),
-        (f'AT+CGDCONT=1,"IP","{APN}"', 1),
-        ('AT+NETOPEN', 2),
-        ('AT+IPADDR',  1),
-    ]   
-    for cmd, w in steps:
-        send_at(ser, cmd, w)
-
-    send_at(ser, f'AT+CIPCLOSE={SOCKET_ID}', wait=2)
+        ('AT',       0.5, AT_DONE),
+        ('ATE0',     0.5, AT_DONE),
+    ]
+    # only needed when the bearer isn't still open from a previous run
+    bearer_steps = [
+        ('AT+CPIN?', 0.5, AT_DONE),
+        ('AT+CGATT?',0.5, AT_DONE),
+        (f'AT+CGDCONT=1,"IP","{APN}"', 1, AT_DONE),
+        ('AT+CIPSENDMODE=0', 0.5, AT_DONE),  # don't wait for the peer's TCP ACK
+        ('AT+NETOPEN', 10, NETOPEN_DONE),
+        ('AT+IPADDR',  1, AT_DONE),
+    ]
+    for cmd, t, done in steps:
+        send_at(ser, cmd, t, done)
+
+    state = modem_is_warm(ser)
+    if state:
+        log.info("♻️ Bearer still open (IP %s); skipping SIM/attach/APN setup",
+                 state.get('ip'))
+    else:
+        for cmd, t, done in bearer_steps:
+            resp = send_at(ser, cmd, t, done)
+        save_modem_state(resp)  # resp is the AT+IPADDR reply
+
+    send_at(ser, f'AT+CIPCLOSE={SOCKET_ID}', 2, CIPCLOSE_DONE)
     # Open TCP socket
     open_cmd = f'AT+CIPOPEN={SOCKET_ID},"TCP","{HOST}",80'
-    send_at(ser, open_cmd, wait=5)
+    resp = send_at(ser, open_cmd, 10, CIPOPEN_DONE)
 
     # Check result
-    resp = send_at(ser, '', wait=0)  # flush buffer
-    # if f'+CIPOPEN: {SOCKET_ID},0' in resp:
-    #     print("✅ TCP socket open")
+    m = CIPOPEN_RE.search(resp)
+    log.info("📶 CIPOPEN result: %r", m.group(0) if m else None)
+    # if b'+CIPOPEN: %d,0' % SOCKET_ID in resp:
+    #     log.info("✅ TCP socket open")
     # else:
-    #     print("🚨 Socket open failed:\n", resp)
+    #     log.error("🚨 Socket open failed: %r", resp)
     #     sys.exit(1)
 
+# === KERNEL SOCKET TRANSPORT ===
+class KeepAliveHTTPConnection(http.client.HTTPConnection):
+    # re-applied on every reconnect
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) < SNDBUF_MIN:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SNDBUF_MIN)
+        if BUSY_POLL_US:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, BUSY_POLL_US)
+            except OSError:
+                pass  # raising it above net.core.busy_read needs CAP_NET_ADMIN
+
+def http_post(conn, body):
+    try:
+        conn.request("POST", ENDPOINT, body, {"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        resp.read()
+        log.debug("🛬 Server response: %s %s", resp.status, resp.reason)
+    except (OSError, http.client.HTTPException) as e:
+        log.warning("⚠️ HTTP POST failed: %s", e)
+        conn.close()  # next request reconnects
+
 # === SEND SENSOR DATA AS JSON ===
-def send_json_data(ser, params: dict):
-    # Build JSON payload list
-    json_list = []
-    for k, v in params.items():
-        key = k.strip().lower()
-        if not v:
-            print(f"⚠️ Empty value for '{k}', skipping")
+def parse_number(v):
+    # ints stay ints in the JSON (50, not 50.0)
+    if b"." in v or len(v) > 18:  # longer digit runs may not fit orjson's 64-bit ints
+        return float(v)
+    try:
+        return int(v)
+    except ValueError:
+        return float(v)  # e.g. b"1e3"
+
+def parse_sample(line):
+    # known, numeric pairs of a sensor line as {sensor_type: number}
+    m = FRAME_RE.fullmatch(line)
+    if m:  # fast path: the full frame in the usual order, all numbers
+        return {name: parse_number(v) for name, v in zip(FRAME_NAMES, m.groups())}
+    sample = {}
+    for m in KV_RE.finditer(line):
+        name = SENSOR_NAMES.get(m.group(1).lower())  # also standardizes temp -> temperature
+        value = m.group(2)
+        if name is None or value[:1] not in NUMBER_START:
             continue
         try:
-            val = float(v)
+            sample[name] = parse_number(value)
         except ValueError:
-            print(f"⚠️ Invalid number '{v}' for '{k}', skipping")
             continue
+    return sample
 
-        # standardize
-        if key == 'temp':
-            key = 'temperature'
-
-        json_list.append({"sensor_type": key, "value": val})
+def send_json_batch(link, samples: list):
+    # Build one JSON payload list out of all samples
+    # (values were checked by parse_sample() in the reader)
+    json_list = [{"sensor_type": k, "value": v}
+                 for params in samples for k, v in params.items()]
 
     if not json_list:
-        print("🤷 No valid data to send.")
+        log.info("🤷 No valid data to send.")
+        return
+
+    body = json_dumps(json_list)
+    if TRANSPORT == 'socket':  # link is a KeepAliveHTTPConnection
+        http_post(link, body)
         return
 
-    json_str = json.dumps(json_list)
-    http = (
-        f"POST {ENDPOINT} HTTP/1.1\r\n"
-        f"Host: {HOST}\r\n"
-        "Connection: keep-alive\r\n"
-        "Content-Type: application/json\r\n"
-        f"Content-Length: {len(json_str)}\r\n"
-        "\r\n"
-        f"{json_str}"
-    )
-    print(f"\n🌐 Full HTTP payload:\n{http.strip()}")   
+    # link is the modem's serial port
+    http = HTTP_HEAD + b"%d" % len(body) + HTTP_TAIL
+    log.debug("🌐 Full HTTP payload: %r %r", http, body)
 
     # Send via AT+CIPSEND
-    ser.reset_input_buffer()
-    cmd = f'AT+CIPSEND={SOCKET_ID},{len(http.encode())}'
-    ser.write((cmd + '\r\n').encode())
+    check_last_send(link)
+    link.write(CIPSEND_FMT % (SOCKET_ID, len(http) + len(body)))
 
-    if not wait_for(ser, '>', timeout=3):
-        print("⚠️ No '>' prompt; skipping send.")
+    if not wait_for(link, b'>', timeout=3):
+        log.warning("⚠️ No '>' prompt; skipping send.")
         return
 
-    ser.write(http.encode())
-    print(f"📤 Sent JSON: {json_str}")
+    writev_all(link, [http, body])
+    log.debug("📤 Sent JSON: %r", body)
+    # the "+CIPSEND:" ack is picked up by check_last_send() on the next send
+
+class BatchingManager:
+    """Sends samples as one POST once BATCH_MAX are queued or BATCH_MS have passed."""
+
+    def __init__(self, link):
+        self.link = link
+        self.buf = []
+        self.last_flush = time.time()
+        self.sent = 0
+
+    def add(self, sample: dict):
+        self.buf.append(sample)
+        self.poll()
+
+    def poll(self):
+        if not self.buf:
+            return
+        if (self.sent < BATCH_AFTER
+                or len(self.buf) >= BATCH_MAX
+                or time.time() - self.last_flush > BATCH_MS / 1000):
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            try:
+                send_json_batch(self.link, self.buf)
+                self.sent += len(self.buf)
+            finally:
+                self.buf.clear()  # never resend a batch that just failed
+        self.last_flush = time.time()
+
+# === SENSOR READER ===
+def sensor_reader(sensor, samples, stop, failed):
+    # Runs in its own thread so lines keep arriving while the modem is busy
+    err_count = 0
+    try:
+        for raw in sensor_lines(sensor, stop):
+            raw = raw.strip()
+            if not raw:
+                continue
 
-    time.sleep(1)
-    resp = ser.read_all().decode(errors='ignore')
-    print(f"🛬 Modem response:\n{resp.strip()}\n")
+            log.debug("📨 From STM32: %r", raw)
+            try:
+                if len(raw) > LINE_MAX:
+                    raise ValueError("line over LINE_MAX bytes")
+                data = parse_sample(raw)  # unknown keys and bad values are dropped
+                if not data:
+                    raise ValueError("no valid key=value pairs")
+                samples.put_nowait(data)
+            except queue.Full:
+                log.warning("⚠️ Sample queue full; dropping %r", raw)
+            except Exception as e:
+                # bounded, so garbled input can't stall the reader on logging
+                err_count += 1
+                if err_count == 1 or err_count % ERR_LOG_EVERY == 0:
+                    log.warning("⚠️ Parse errors: %d, last: %s | Line: %r",
+                                err_count, e, raw[:64])
+    except (serial.SerialException, OSError) as e:
+        log.error("❌ Sensor port error: %s", e)
+        failed.set()
+    finally:
+        stop.set()
 
 # === MAIN LOOP ===
 def main():
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO").upper(),
+                        format="%(message)s")
+    if TRANSPORT not in ('at', 'socket'):
+        log.error("❌ Unknown TRANSPORT %r (expected 'at' or 'socket')", TRANSPORT)
+        sys.exit(1)
     try:
-        print(f"🔌 Opening ports: modem={MODEM_PORT}, sensor={DATA_PORT}")
-        modem  = serial.Serial(MODEM_PORT, BAUD_MODEM, timeout=1)
+        log.info("🔌 Opening ports: modem=%s, sensor=%s, transport=%s",
+                 MODEM_PORT, DATA_PORT, TRANSPORT)
+        modem  = None
+        if TRANSPORT == 'at':
+            modem = serial.Serial(MODEM_PORT, BAUD_MODEM, timeout=1)
         sensor = serial.Serial(DATA_PORT,  BAUD_DATA,  timeout=1)
     except Exception as e:
-        print(f"❌ Could not open serial ports: {e}")
+        log.error("❌ Could not open serial ports: %s", e)
         sys.exit(1)
 
-    init_modem(modem)
-    print("\n▶️ Reading sensor data and sending JSON…")
+    enable_low_latency(sensor)
+    if modem:
+        init_modem(modem)
+        link = modem
+    else:
+        link = KeepAliveHTTPConnection(HOST, 80, timeout=10)  # connects on first POST
+    log.info("▶️ Reading sensor data and sending JSON…")
+    batcher = BatchingManager(link)
 
-    try:
-        while True:
-            raw = sensor.readline().decode(errors='ignore').strip()
-            if not raw:
-                time.sleep(0.2)
-                continue
+    # reader thread owns the sensor port, this thread owns the uplink
+    samples = queue.Queue(maxsize=QUEUE_MAX)
+    stop = threading.Event()
+    failed = threading.Event()  # set by the reader when the sensor port dies
+    reader = threading.Thread(target=sensor_reader, args=(sensor, samples, stop, failed),
+                              daemon=True)
+    reader.start()
 
-            print(f"\n📨 From STM32: {raw}")
+    try:
+        while not stop.is_set():
             try:
-                parts = [p.split('=') for p in raw.split(',')]
-                data = {k.strip(): v.strip() for k, v in parts if len(p) == 2}
-                if data:
-                    send_json_data(modem, data)
-                else:
-                    print("⚠️ Malformed line; no key=value pairs found")
-            except Exception as e:
-                print(f"⚠️ Processing error: {e}")
-                traceback.print_exc()
-
-            time.sleep(1)
+                batcher.add(samples.get(timeout=PERIOD))
+            except queue.Empty:
+                batcher.poll()
 
     except KeyboardInterrupt:
-        print("\n✋ Interrupted. Cleaning up…")
+        log.info("✋ Interrupted. Cleaning up…")
     finally:
-        send_at(modem, f'AT+CIPCLOSE={SOCKET_ID}', 2)
-        send_at(modem, 'AT+NETCLOSE', 1)
-        modem.close()
+        stop.set()
+        reader.join(timeout=2)
+        while not samples.empty():
+            batcher.add(samples.get_nowait())  # add() keeps each send within BATCH_MAX
+        batcher.flush()
+        if modem:
+            # bearer stays open so the next start can skip its setup
+            send_at(modem, f'AT+CIPCLOSE={SOCKET_ID}', 2, CIPCLOSE_DONE)
+            modem.close()
+        else:
+            link.close()
         sensor.close()
-        print("✅ Shutdown complete.")
+
+    if failed.is_set():
+        # non-zero so a supervisor (e.g. systemd Restart=on-failure) restarts us
+        sys.exit(1)
+    log.info("✅ Shutdown complete.")
 
 if __name__ == '__main__':
     main()
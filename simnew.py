@@ -1,8 +1,21 @@
 #!/usr/bin/env python3
 import serial
+import array
+import fcntl
+import http.client
+import os
+import select
+import socket
+import termios
 import time
 import sys
-import traceback
+import json
+import logging
+import queue
+import re
+import threading
+
+log = logging.getLogger("telemetry")
 
 # === CONFIGURATION ===
 MODEM_PORT = '/dev/serial0'         # UART to SIM7600 (GPIO pins)
@@ -13,156 +26,454 @@ APN        = 'internet.orange.co.bw'
 HOST       = 'merlet.alwaysdata.net'
 ENDPOINT   = '/endpoint.php?'
 SOCKET_ID  = 0
+STATE_FILE = '/run/telemetry_modem.state'  # APN/IP of the last good init; cleared on reboot
+PERIOD     = 1.0                    # minimum seconds between sends
+QUEUE_MAX  = 100                    # readings buffered between reader and sender
+ERR_LOG_EVERY = 100                 # log the first bad sensor line, then every Nth
+LINE_MAX   = 4096                   # longer sensor lines are dropped as garbage
+
+# 'at': AT+CIPSEND over MODEM_PORT; 'socket': kernel TCP over wwan0, brought up first with
+#   qmicli -d /dev/cdc-wdm0 --wds-start-network="apn='internet.orange.co.bw'"
+TRANSPORT  = os.environ.get('TRANSPORT', 'at')
+# Socket transport: busy-poll for this many µs before sleeping (off by default,
+# try 50 once the process is pinned), and a send buffer of at least one GET
+BUSY_POLL_US = int(os.environ.get('BUSY_POLL_US', '0'))
+SNDBUF_MIN   = 4096
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)  # missing before Python 3.12
+
+# Keys we expect from the sensor (uppercase, matched against the raw bytes)
+EXPECTED_KEYS = {b'SPEED', b'TEMP', b'GEAR', b'FUEL', b'RPM'}
+# One "key=value" reading per sensor line; the value goes into the URL as is,
+# so it is limited to printable ASCII and must make up the rest of the line
+KV_RE = re.compile(rb"\s*([A-Za-z_][A-Za-z0-9_]*)\s*=\s*([!-~]+)")
+
+# Constant parts of the GET request around the query string
+HTTP_HEAD = f"GET {ENDPOINT}".encode()
+HTTP_TAIL = (
+    " HTTP/1.1\r\n"
+    f"Host: {HOST}\r\n"
+    "Connection: keep-alive\r\n\r\n"
+).encode()
+CIPSEND_FMT = b"AT+CIPSEND=%d,%d\r\n"
 
-# Keys we expect from the sensor (uppercase)
-EXPECTED_KEYS = {'SPEED', 'TEMP', 'GEAR', 'FUEL', 'RPM'}
+# Final result codes that end a plain AT command reply
+AT_DONE = (b"\r\nOK\r\n", b"\r\nERROR\r\n")
+CIPOPEN_RE = re.compile(rb"\+CIPOPEN: (\d+),(\d+)")
+# URC replies that follow "OK"; matched as whole lines so the status code is
+# always in the response. A non-zero close code is followed by ERROR, so only
+# code 0 may end a close early -- otherwise that ERROR would be left behind
+# for the next command to read.
+NETOPEN_DONE  = (re.compile(rb"\+NETOPEN: \d+\r\n"), b"\r\nERROR\r\n")
+NETCLOSE_DONE = (re.compile(rb"\+NETCLOSE: 0\r\n"), b"\r\nERROR\r\n")
+CIPOPEN_DONE  = (re.compile(rb"\+CIPOPEN: \d+,\d+\r\n"), b"\r\nERROR\r\n")
+CIPCLOSE_DONE = (re.compile(rb"\+CIPCLOSE: \d+,0\r\n"), b"\r\nERROR\r\n")
+IPADDR_RE  = re.compile(rb"\+IPADDR: ([0-9.]+)")
+IPD_RE     = re.compile(rb"\+IPD(\d+)\r\n")  # header of data received on the socket
 
 # === AT-COMMAND HELPERS ===
-def send_at(ser, cmd, wait=1):
-    print(f"📡 Sending AT: {cmd}")
+_pollers = {}  # fd -> select.poll() watching it for input
+
+def _poller(ser):
+    fd = ser.fileno()
+    poller = _pollers.get(fd)
+    if poller is None:
+        poller = _pollers[fd] = select.poll()
+        poller.register(fd, select.POLLIN)
+    return poller
+
+def read_until(ser, terminators=AT_DONE, timeout=1):
+    fd = ser.fileno()
+    poller = _poller(ser)
+    deadline = time.time() + timeout
+    buf = bytearray()
+    while True:
+        remaining_ms = int((deadline - time.time()) * 1000)
+        if remaining_ms <= 0 or not poller.poll(remaining_ms):
+            break
+        chunk = os.read(fd, 4096)
+        if not chunk:  # port went away
+            break
+        buf += chunk
+        # terminators are plain bytes or compiled patterns
+        if any(t.search(buf) if isinstance(t, re.Pattern) else t in buf
+               for t in terminators):
+            break
+    return bytes(buf)
+
+def send_at(ser, cmd, timeout=1, terminators=AT_DONE):
+    log.debug("📡 Sending AT: %s", cmd)
     ser.write((cmd + '\r\n').encode())
-    time.sleep(wait)
-    resp = ser.read_all().decode(errors='ignore')
-    print(f"📩 Response: {resp.strip()}")
+    resp = read_until(ser, terminators, timeout)
+    log.debug("📩 Response: %r", resp)
     return resp
 
-def wait_for(ser, keyword, timeout=5):
-    print(f"⏳ Waiting for '{keyword}' (up to {timeout}s)...")
+def strip_ipd(buf):
+    # server data arrives as "+IPD<len>\r\n<payload>"; drop the payloads so a '>'
+    # in e.g. HTML is never taken for the CIPSEND prompt. Also returns how many
+    # payload bytes are still to come.
+    out = bytearray()
+    pos = 0
+    while True:
+        m = IPD_RE.search(buf, pos)
+        if not m:
+            out += buf[pos:]
+            return out, 0
+        out += buf[pos:m.start()]
+        pos = m.end() + int(m.group(1))
+        if pos >= len(buf):
+            return out, pos - len(buf)
+
+def wait_for(ser, keyword, timeout=5, _buf=bytearray()):
+    log.debug("⏳ Waiting for %r (up to %ss)...", keyword, timeout)
+    fd = ser.fileno()
+    poller = _poller(ser)
     deadline = time.time() + timeout
-    buf = ''
-    while time.time() < deadline:
-        buf += ser.read(ser.in_waiting or 1).decode(errors='ignore')
-        if keyword in buf:
-            print(f"✅ Got '{keyword}'")
+    _buf.clear()  # shared across calls; only the modem thread waits
+    while True:
+        remaining_ms = int((deadline - time.time()) * 1000)
+        if remaining_ms <= 0 or not poller.poll(remaining_ms):
+            break
+        chunk = os.read(fd, 4096)
+        if not chunk:  # port went away
+            break
+        _buf.extend(chunk)
+        if strip_ipd(_buf)[0].find(keyword) != -1:
+            log.debug("✅ Got %r", keyword)
             return True
-    print(f"❌ Timeout waiting for '{keyword}'")
+    log.warning("❌ Timeout waiting for %r", keyword)
     return False
 
+def writev_all(ser, chunks):
+    try:
+        n = os.writev(ser.fileno(), chunks)
+    except BlockingIOError:  # pyserial opens the port non-blocking
+        n = 0
+    for chunk in chunks:
+        if n >= len(chunk):
+            n -= len(chunk)
+            continue
+        ser.write(memoryview(chunk)[n:])
+        n = 0
+
+def check_last_send(ser):
+    # Collects the previous send's "+CIPSEND: <id>,<req>,<cnf>" ack without waiting for it
+    resp = ser.read(ser.in_waiting)
+    if not resp:
+        return
+    resp, missing = strip_ipd(resp)
+    if missing:  # the server's reply is still arriving; read and drop the rest
+        ser.read(missing)
+    log.debug("🛬 Modem response since last send: %r", resp)
+    if any(t in resp for t in (b"\r\nERROR\r\n", b"+CIPERROR:", b"+IPCLOSE:")):
+        log.warning("⚠️ Previous send failed or socket closed: %r", resp)
+
+# === SENSOR PORT TUNING ===
+ASYNC_LOW_LATENCY = 1 << 13  # from linux/serial.h
+
+def enable_low_latency(ser):
+    try:
+        try:
+            ser.set_low_latency_mode(True)
+        except AttributeError:  # pyserial < 3.5
+            buf = array.array('i', [0] * 32)
+            fcntl.ioctl(ser.fileno(), termios.TIOCGSERIAL, buf)
+            buf[4] |= ASYNC_LOW_LATENCY  # serial_struct.flags
+            fcntl.ioctl(ser.fileno(), termios.TIOCSSERIAL, buf)
+    except (OSError, ValueError) as e:
+        log.warning("⚠️ Could not set low-latency mode on %s: %s", ser.port, e)
+
+    # FTDI-style adapters also buffer for latency_timer ms (default 16)
+    tty = os.path.basename(os.path.realpath(ser.port))
+    try:
+        with open(f"/sys/bus/usb-serial/devices/{tty}/latency_timer", "w") as f:
+            f.write("1")
+    except OSError:
+        pass  # not a usb-serial device, or not running as root
+
+def sensor_lines(ser, stop, timeout=1):
+    # one os.read() per chunk that arrives, instead of readline()'s read per byte
+    fd = ser.fileno()
+    poller = _poller(ser)
+    buf = bytearray()
+    scanned = 0       # bytes of buf already known to hold no newline
+    skipping = False  # dropping the rest of a line that went over LINE_MAX
+    while not stop.is_set():
+        if not poller.poll(timeout * 1000):
+            continue
+        chunk = os.read(fd, 4096)
+        if not chunk:  # readable but empty: the adapter was unplugged
+            raise serial.SerialException(f"{ser.port} returned no data")
+        buf += chunk
+        start = 0
+        end = buf.find(b"\n", scanned)  # earlier bytes were already searched
+        while end >= 0:
+            if skipping:  # tail of an overlong line
+                skipping = False
+            else:
+                yield bytes(buf[start:end + 1])
+            start = end + 1
+            end = buf.find(b"\n", start)
+        del buf[:start]
+        if len(buf) > LINE_MAX:
+            if not skipping:
+                yield bytes(buf)  # the reader rejects it as too long
+            skipping = True
+            buf.clear()
+        scanned = len(buf)
+
+# === MODEM STATE ACROSS RESTARTS ===
+def load_modem_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_modem_state(ipaddr_resp):
+    # only a bearer that actually got an IP is worth reusing
+    m = IPADDR_RE.search(ipaddr_resp)
+    if not m:
+        return
+    try:
+        with open(STATE_FILE, 'w') as f:
+            json.dump({'apn': APN, 'ip': m.group(1).decode()}, f)
+    except OSError as e:
+        log.debug("Could not write %s: %s", STATE_FILE, e)
+
+def modem_is_warm(ser):
+    # saved state for our APN *and* the modem says the bearer is still open
+    state = load_modem_state()
+    if not state or state.get('apn') != APN:
+        return None
+    if b"+NETOPEN: 1" not in send_at(ser, "AT+NETOPEN?"):
+        return None
+    return state
+
 # === MODEM INIT & SOCKET OPEN ===
 def init_modem(ser):
-    print("🔧 Initializing modem…")
+    log.info("🔧 Initializing modem…")
+    # (command, timeout, terminators) -- timeouts are upper bounds now
     steps = [
-        ('AT',      0.5),
-        ('ATE0',    0.5),
-        ('AT+CPIN?',0.5),
-        ('AT+CGATT?',0.5),
-        (f'AT+CGDCONT=1,"IP","{APN}"', 1),
-        ('AT+NETOPEN', 2),
-        ('AT+IPADDR',  1),
+        ('AT',      0.5, AT_DONE),
+        ('ATE0',    0.5, AT_DONE),
     ]
-    for cmd, wait in steps:
-        send_at(ser, cmd, wait)
+    # only needed when the bearer isn't still open from a previous run
+    bearer_steps = [
+        ('AT+CPIN?',0.5, AT_DONE),
+        ('AT+CGATT?',0.5, AT_DONE),
+        (f'AT+CGDCONT=1,"IP","{APN}"', 1, AT_DONE),
+        ('AT+CIPSENDMODE=0', 0.5, AT_DONE),  # don't wait for the peer's TCP ACK
+        ('AT+NETOPEN', 10, NETOPEN_DONE),
+        ('AT+IPADDR',  1, AT_DONE),
+    ]
+    for cmd, timeout, done in steps:
+        send_at(ser, cmd, timeout, done)
+
+    state = modem_is_warm(ser)
+    if state:
+        log.info("♻️ Bearer still open (IP %s); skipping SIM/attach/APN setup",
+                 state.get('ip'))
+        # drop a socket a crashed run may have left open
+        send_at(ser, f'AT+CIPCLOSE={SOCKET_ID}', 2, CIPCLOSE_DONE)
+    else:
+        for cmd, timeout, done in bearer_steps:
+            resp = send_at(ser, cmd, timeout, done)
+        save_modem_state(resp)  # resp is the AT+IPADDR reply
 
     open_cmd = f'AT+CIPOPEN={SOCKET_ID},"TCP","{HOST}",80'
-    send_at(ser, open_cmd, 2)
-
-    # read any extra data
-    time.sleep(1)
-    combo = ser.read_all().decode(errors='ignore')
-    print(f"📶 CIPOPEN response:\n{combo.strip()}")
-    if f'+CIPOPEN: {SOCKET_ID},0' in combo:
-        print("✅ TCP socket open")
+    # "OK" comes first, the "+CIPOPEN: <id>,<err>" URC follows once connected
+    combo = send_at(ser, open_cmd, 10, CIPOPEN_DONE)
+    log.debug("📶 CIPOPEN response: %r", combo)
+    m = CIPOPEN_RE.search(combo)
+    if m and int(m.group(1)) == SOCKET_ID and m.group(2) == b"0":
+        log.info("✅ TCP socket open")
     else:
-        print("🚨 Socket open failed, exiting")
+        log.error("🚨 Socket open failed, exiting")
         sys.exit(1)
 
+# === KERNEL SOCKET TRANSPORT ===
+class KeepAliveHTTPConnection(http.client.HTTPConnection):
+    # re-applied on every reconnect
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) < SNDBUF_MIN:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SNDBUF_MIN)
+        if BUSY_POLL_US:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, BUSY_POLL_US)
+            except OSError:
+                pass  # raising it above net.core.busy_read needs CAP_NET_ADMIN
+
+def http_get(conn, path):
+    try:
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        resp.read()
+        log.debug("🛬 Server response: %s %s", resp.status, resp.reason)
+        return True
+    except (OSError, http.client.HTTPException) as e:
+        log.warning("⚠️ HTTP GET failed: %s", e)
+        conn.close()  # next request reconnects
+        return False
+
 # === SEND A BATCH OF READINGS ===
-def send_data(ser, params: dict):
-    # build GET request path
-    query = '&'.join(f"{k}={v}" for k, v in params.items())
-    payload = (
-        f"GET {ENDPOINT}{query} HTTP/1.1\r\n"
-        f"Host: {HOST}\r\n"
-        "Connection: keep-alive\r\n\r\n"
-    )
-    print(f"\n🌐 Full HTTP payload:\n{payload.strip()}")
-
-    # clear buffer & request send
-    ser.reset_input_buffer()
-    cmd = f'AT+CIPSEND={SOCKET_ID},{len(payload)}'
-    ser.write((cmd + '\r\n').encode())
+def send_data(link, params: dict, _req=bytearray()):
+    # build the whole GET request in place; _req is reused, only the main thread sends
+    _req.clear()
+    _req += HTTP_HEAD
+    for k, v in params.items():
+        _req += k
+        _req += b'='
+        _req += v
+        _req += b'&'
+    del _req[-1]  # trailing '&'
+    query_end = len(_req)
+    _req += HTTP_TAIL
+
+    if TRANSPORT == 'socket':  # link is a KeepAliveHTTPConnection
+        if http_get(link, _req[4:query_end].decode()):  # path without the "GET "
+            log.info("✅ Sent batch: %s", params)
+        return
+
+    # link is the modem's serial port
+    log.debug("🌐 Full HTTP payload: %r", _req)
+
+    # collect the last ack & request send
+    check_last_send(link)
+    link.write(CIPSEND_FMT % (SOCKET_ID, len(_req)))
 
     # wait for prompt (retry once if necessary)
-    if not wait_for(ser, '>', timeout=2):
-        print("⚠️ No '>' prompt; retrying once…")
+    if not wait_for(link, b'>', timeout=2):
+        log.warning("⚠️ No '>' prompt; retrying once…")
         time.sleep(0.5)
-        if not wait_for(ser, '>', timeout=2):
-            print("❌ Still no prompt; skipping this batch")
+        if not wait_for(link, b'>', timeout=2):
+            log.warning("❌ Still no prompt; skipping this batch")
             return
 
     # send payload
-    print("🚀 Sending payload…")
-    ser.write(payload.encode())
+    log.debug("🚀 Sending payload…")
+    writev_all(link, [_req])
 
-    # read the response
-    time.sleep(1)
-    resp = ser.read_all().decode(errors='ignore')
-    print(f"🛬 Modem response:\n{resp.strip()}")
-    print(f"✅ Sent batch: {params}\n")
+    # the "+CIPSEND:" ack is picked up by check_last_send() on the next send
+    log.info("✅ Sent batch: %s", params)
+
+# === SENSOR READER ===
+def sensor_reader(sensor, readings, stop, failed):
+    # Runs in its own thread so readings keep arriving while the modem is busy
+    err_count = 0
+    try:
+        for raw in sensor_lines(sensor, stop, timeout=0.5):
+            raw = raw.strip()  # stays bytes all the way to the uplink
+            if not raw:
+                continue
+
+            log.debug("🧾 Raw sensor line: %r", raw)
+            try:
+                if len(raw) > LINE_MAX:
+                    raise ValueError("line over LINE_MAX bytes")
+                m = KV_RE.fullmatch(raw)
+                if not m:
+                    raise ValueError("malformed line")
+                key = m.group(1).upper()
+                if key not in EXPECTED_KEYS:
+                    raise ValueError(f"unknown key {key!r}")
+
+                readings.put_nowait((key, m.group(2)))
+
+            except queue.Full:
+                log.warning("⚠️ Reading queue full; dropping %r", raw)
+            except Exception as e:
+                # bounded, so garbled input can't stall the reader on logging
+                err_count += 1
+                if err_count == 1 or err_count % ERR_LOG_EVERY == 0:
+                    log.warning("⚠️ Parse errors: %d, last: %s | Line: %r",
+                                err_count, e, raw[:64])
+    except (serial.SerialException, OSError) as e:
+        log.error("❌ Sensor port error: %s", e)
+        failed.set()
+    finally:
+        stop.set()
 
 # === MAIN LOOP ===
 def main():
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO").upper(),
+                        format="%(message)s")
+    if TRANSPORT not in ('at', 'socket'):
+        log.error("❌ Unknown TRANSPORT %r (expected 'at' or 'socket')", TRANSPORT)
+        sys.exit(1)
     try:
-        print(f"🔌 Opening ports: modem={MODEM_PORT}, sensor={DATA_PORT}")
-        modem  = serial.Serial(MODEM_PORT, BAUD_MODEM, timeout=0.5)
+        log.info("🔌 Opening ports: modem=%s, sensor=%s, transport=%s",
+                 MODEM_PORT, DATA_PORT, TRANSPORT)
+        modem  = None
+        if TRANSPORT == 'at':
+            modem = serial.Serial(MODEM_PORT, BAUD_MODEM, timeout=0.5)
         sensor = serial.Serial(DATA_PORT,  BAUD_DATA,  timeout=0.5)
     except Exception as e:
-        print(f"❌ Failed to open serial ports: {e}")
+        log.error("❌ Failed to open serial ports: %s", e)
         sys.exit(1)
 
-    init_modem(modem)
-    print("▶️ Entering main loop… collecting sensor readings.\n")
+    enable_low_latency(sensor)
+    if modem:
+        init_modem(modem)
+        link = modem
+    else:
+        link = KeepAliveHTTPConnection(HOST, 80, timeout=10)  # connects on first GET
+    log.info("▶️ Entering main loop… collecting sensor readings.")
+
+    # reader thread owns the sensor port, this thread owns the uplink
+    readings = queue.Queue(maxsize=QUEUE_MAX)
+    stop = threading.Event()
+    failed = threading.Event()  # set by the reader when the sensor port dies
+    reader = threading.Thread(target=sensor_reader, args=(sensor, readings, stop, failed),
+                              daemon=True)
+    reader.start()
 
     buffer = {}  # holds the latest values
+    cycle_start = time.monotonic()
 
     try:
-        while True:
-            raw = sensor.readline().decode(errors='ignore').strip()
-            if not raw:
-                continue
-
-            print(f"🧾 Raw sensor line: {raw}")
+        while not stop.is_set():
             try:
-                if '=' not in raw:
-                    print("⚠️ Skipping malformed line")
-                    continue
-                key, val = raw.split('=', 1)
-                key = key.strip().upper()
-                val = val.strip()
-
-                if key not in EXPECTED_KEYS:
-                    print(f"⚠️ Unknown key '{key}'; skipping")
-                    continue
-                if not val:
-                    print(f"⚠️ Empty value for '{key}'; skipping")
-                    continue
-
-                buffer[key] = val
-                print(f"🔄 Buffer state: {buffer}")
+                key, val = readings.get(timeout=1)
+            except queue.Empty:
+                continue
 
-                # once we have them all, send and reset
-                if EXPECTED_KEYS.issubset(buffer.keys()):
-                    send_data(modem, buffer)
-                    buffer.clear()
-                    time.sleep(0.5)
+            buffer[key] = val
+            log.debug("🔄 Buffer state: %s", buffer)
 
-            except Exception as e:
-                print(f"⚠️ Parse error: {e} | Line: {raw}")
-                traceback.print_exc()
+            # once we have them all, send and reset
+            if EXPECTED_KEYS.issubset(buffer.keys()):
+                send_data(link, buffer)
+                buffer.clear()
+                slack = PERIOD - (time.monotonic() - cycle_start)
+                if slack > 0:
+                    time.sleep(slack)  # the reader keeps queueing meanwhile
+                cycle_start = time.monotonic()
 
     except KeyboardInterrupt:
-        print("\n✋ Interrupted by user, shutting down…")
+        log.info("✋ Interrupted by user, shutting down…")
 
     finally:
-        print("🧹 Closing connections…")
-        try:
-            modem.write(f'AT+CIPCLOSE={SOCKET_ID}\r\n'.encode())
-            modem.write(b'AT+NETCLOSE\r\n')
-        except:
-            pass
-        modem.close()
+        log.info("🧹 Closing connections…")
+        stop.set()
+        reader.join(timeout=2)
+        if modem:
+            try:
+                # bearer stays open so the next start can skip its setup
+                modem.write(f'AT+CIPCLOSE={SOCKET_ID}\r\n'.encode())
+            except:
+                pass
+            modem.close()
+        else:
+            link.close()
         sensor.close()
-        print("✅ Clean exit.")
+
+    if failed.is_set():
+        # non-zero so a supervisor (e.g. systemd Restart=on-failure) restarts us
+        sys.exit(1)
+    log.info("✅ Clean exit.")
 
 if __name__ == '__main__':
     main()